@@ -131,17 +131,17 @@ const App: React.FC = () => {
       wsRef.current = new WSClient(url, onMessage, onStatus);
       wsRef.current.connect();
       wsSendRef.current = window.setInterval(() => {
-        const ks = eventsRef.current.slice(-200).map(e => ({
-          type: e.type === 'down' ? 'keydown' : 'keyup',
-          key: e.key,
-          timestamp: e.timestamp / 1000,
-        }));
-        const ms = mouseRef.current.slice(-200).map(m => ({
-          x: m.x,
-          y: m.y,
-          timestamp: m.timestamp / 1000,
-        }));
-        wsRef.current?.send({ keystrokes: ks, mouse: ms });
+        // Columnar payload: one array per field (see payload_columns on the backend)
+        const ks = eventsRef.current.slice(-200);
+        const ms = mouseRef.current.slice(-200);
+        wsRef.current?.send({
+          ks_ts: ks.map(e => e.timestamp / 1000),
+          ks_type: ks.map(e => (e.type === 'down' ? 'keydown' : 'keyup')),
+          ks_key: ks.map(e => e.key),
+          mx: ms.map(m => m.x),
+          my: ms.map(m => m.y),
+          mt: ms.map(m => m.timestamp / 1000),
+        });
       }, 1000);
     } else {
       if (wsSendRef.current) { clearInterval(wsSendRef.current); wsSendRef.current = null; }
@@ -275,12 +275,15 @@ const App: React.FC = () => {
     canvasRef.current.width = videoRef.current.videoWidth / 2;
     canvasRef.current.height = videoRef.current.videoHeight / 2;
     ctx?.drawImage(videoRef.current, 0, 0, canvasRef.current.width, canvasRef.current.height);
-    const base64Image = canvasRef.current.toDataURL('image/png', 0.9);
+    // Send the encoded PNG as a binary multipart part instead of a base64 data URL
+    const blob = await new Promise<Blob | null>(resolve => canvasRef.current.toBlob(resolve, 'image/png', 0.9));
+    if (!blob) return;
+    const form = new FormData();
+    form.append('file', blob, 'screenshot.png');
     try {
-      await fetch(`http://${window.location.hostname}:5051/media/upload`, {
+      await fetch(`http://${window.location.hostname}:5051/media/screenshot-bin`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ image: base64Image, format: 'png' }),
+        body: form,
       });
     } catch (e) {
       console.warn('Auto screenshot error', e);
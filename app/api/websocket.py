@@ -3,51 +3,109 @@ Cybersecurity Thesis Context:
 
 This WebSocket ingests real-time keystroke and mouse telemetry. The trust score
 is kept in Redis for low-latency updates visible across the stack. We enforce
-privacy by encrypting raw payloads in the audit log using Fernet so that even
+privacy by encrypting raw payloads in the audit log (AES-GCM) so that even
 if the database is compromised, sensitive behavior remains protected.
 
-Additionally, a trust-decay loop penalizes idle connections to reduce the risk
-that unattended sessions retain elevated privileges.
+Additionally, trust decays while a connection is idle to reduce the risk that
+unattended sessions retain elevated privileges. Decay is applied lazily: the
+idle time since the last update is charged the next time the score changes.
 """
 
 from __future__ import annotations
 
 import asyncio
-import json
-from typing import Any, Dict
+import contextlib
+import itertools
+import time
+from concurrent.futures import Executor
+from typing import Any, Dict, List, Optional, Tuple
 
+import orjson
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import insert
+try:
+    from redis.exceptions import NoScriptError
+except Exception:  # pragma: no cover
+    class NoScriptError(Exception):  # type: ignore
+        pass
 
 from app.core.config import settings
-from app.core.security import get_fernet
-from app.db.models import AsyncSessionLocal, AuditLog
-from app.services.ml_engine import BiometricEngine
+from app.core.security import AuditCipher
+from app.services.ml_engine import BiometricEngine, merge_payloads
 
 
 router = APIRouter()
 
 
-async def _get_trust(redis, client_id: str) -> int:
-    val = await redis.get(f"trust:{client_id}")
-    if val is None:
-        return settings.TRUST_INITIAL_SCORE
-    try:
-        return int(val)
-    except Exception:
-        return settings.TRUST_INITIAL_SCORE
+# Decay, adjust and clamp a client's trust score in a single round trip.
+# The score lives in a hash {v, ts}; one decay step is charged per full decay
+# interval elapsed since ts. KEYS[1] = trust key; ARGV = initial, min, max,
+# delta, now, decay_seconds, decay_points. Returns {previous (decayed), new}.
+TRUST_ADJUST_LUA = """
+local cur = redis.call('HMGET', KEYS[1], 'v', 'ts')
+local lo, hi, now = tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[5])
+local prev = tonumber(cur[1]) or tonumber(ARGV[1])
+local steps = math.floor((now - (tonumber(cur[2]) or now)) / tonumber(ARGV[6]))
+if steps > 0 then
+  prev = math.max(lo, prev - steps * tonumber(ARGV[7]))
+end
+local v = math.max(lo, math.min(hi, prev + tonumber(ARGV[4])))
+redis.call('HSET', KEYS[1], 'v', v, 'ts', now)
+return {prev, v}
+"""
+
+
+def _trust_delta_rule(has_usb: bool, usb_suspicious: bool, is_bot: bool, is_outlier: bool) -> int:
+    # USB events take precedence, then bot heuristics, then the anomaly label
+    if has_usb:
+        return -20 if usb_suspicious else -5
+    if is_bot:
+        return -30
+    if is_outlier:
+        return -10
+    return +1
+
 
+# Precomputed trust deltas keyed by (has_usb, usb_suspicious, is_bot, is_outlier)
+TRUST_DELTAS: Dict[Tuple[bool, bool, bool, bool], int] = {
+    key: _trust_delta_rule(*key)
+    for key in itertools.product((False, True), repeat=4)
+}
 
-async def _set_trust(redis, client_id: str, value: int) -> int:
-    value = max(settings.TRUST_MIN_SCORE, min(settings.TRUST_MAX_SCORE, value))
-    await redis.set(f"trust:{client_id}", value)
-    return value
+# Indexed by (risk >= 30) + (risk >= 60)
+_FOCUS_LEVELS = ("High", "Medium", "Distracted")
 
 
-async def _adjust_trust(redis, client_id: str, delta: int) -> int:
-    current = await _get_trust(redis, client_id)
-    return await _set_trust(redis, client_id, current + delta)
+def _is_keepalive(payload: Dict[str, Any]) -> bool:
+    # {} or {"ping": ...} keep the socket open but carry no telemetry
+    return not payload or payload.keys() <= {"ping"}
+
+
+async def load_trust_script(redis) -> str:
+    return await redis.script_load(TRUST_ADJUST_LUA)
+
+
+async def _adjust_trust(redis, sha: str, client_id: str, delta: int) -> Tuple[int, int]:
+    key = f"trust:{client_id}"
+    args = (
+        settings.TRUST_INITIAL_SCORE,
+        settings.TRUST_MIN_SCORE,
+        settings.TRUST_MAX_SCORE,
+        delta,
+        time.time(),
+        settings.TRUST_DECAY_SECONDS,
+        settings.TRUST_DECAY_POINTS,
+    )
+    try:
+        prev, value = await redis.evalsha(sha, 1, key, *args)
+    except NoScriptError:
+        # Script cache was flushed (e.g. Redis restart); EVAL reloads it
+        prev, value = await redis.eval(TRUST_ADJUST_LUA, 1, key, *args)
+    return int(prev), int(value)
+
+
+async def _send(websocket: WebSocket, message: Dict[str, Any]) -> None:
+    # Text frame: the dashboard JSON.parse()s event.data directly
+    await websocket.send_text(orjson.dumps(message, option=orjson.OPT_SERIALIZE_NUMPY).decode("utf-8"))
 
 
 @router.websocket("/ws/stream/{client_id}")
@@ -55,78 +113,102 @@ async def stream(websocket: WebSocket, client_id: str) -> None:
     await websocket.accept()
 
     redis = websocket.app.state.redis
+    trust_sha: str = websocket.app.state.trust_sha
     engine: BiometricEngine = websocket.app.state.engine
-    fernet = get_fernet()
-
-    # Initialize trust score for this client
-    await _set_trust(redis, client_id, settings.TRUST_INITIAL_SCORE)
-
-    last_rx = asyncio.Event()
-    last_rx.set()
-
-    async def trust_decay_loop() -> None:
+    cipher: AuditCipher = websocket.app.state.audit_cipher
+    audit_queue: asyncio.Queue = websocket.app.state.audit_queue
+    predict_executor: Optional[Executor] = websocket.app.state.predict_executor
+    loop = asyncio.get_running_loop()
+    xbuf = engine.feature_buffer()
+
+    # Start this client from the initial trust score (a missing key reads as
+    # TRUST_INITIAL_SCORE with no idle time)
+    await redis.delete(f"trust:{client_id}")
+
+    # A reader task feeds frames into a bounded inbox; the processing loop
+    # drains whatever has queued up and scores it as one batch, so a client
+    # streaming micro-frames costs one inference/encrypt/insert per batch.
+    inbox: asyncio.Queue = asyncio.Queue(maxsize=settings.WS_COALESCE_MAX_FRAMES)
+
+    async def reader() -> None:
         try:
             while True:
-                await asyncio.sleep(settings.TRUST_DECAY_SECONDS)
-                if not last_rx.is_set():
-                    # No data received within the window; decay trust
-                    await _adjust_trust(redis, client_id, -settings.TRUST_DECAY_POINTS)
-                # Reset the window for the next interval
-                last_rx.clear()
-        except asyncio.CancelledError:
-            return
-
-    decay_task = asyncio.create_task(trust_decay_loop())
+                await inbox.put(await websocket.receive_text())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            # Never block here: if the processing loop has already failed the
+            # inbox may stay full forever. A dropped sentinel is covered by
+            # the reader_task.done() check below.
+            with contextlib.suppress(asyncio.QueueFull):
+                inbox.put_nowait(None)
+
+    reader_task = asyncio.create_task(reader())
 
     try:
-        while True:
-            data = await websocket.receive_text()
-            last_rx.set()
-            try:
-                payload: Dict[str, Any] = json.loads(data)
-            except json.JSONDecodeError:
-                # Malformed input: penalize trust slightly
-                new_trust = await _adjust_trust(redis, client_id, -2)
-                await websocket.send_json({
-                    "ok": False,
-                    "error": "invalid_json",
-                    "trustScore": new_trust,
-                })
+        closed = False
+        while not closed:
+            if inbox.empty() and reader_task.done():
+                break
+            frames = [await inbox.get()]
+            while not inbox.empty() and len(frames) < settings.WS_COALESCE_MAX_FRAMES:
+                frames.append(inbox.get_nowait())
+            if frames[-1] is None:
+                closed = True
+                frames.pop()
+
+            raws: List[str] = []
+            payloads: List[Dict[str, Any]] = []
+            for data in frames:
+                try:
+                    payload = orjson.loads(data)
+                except orjson.JSONDecodeError:
+                    payload = None
+                if not isinstance(payload, dict):
+                    # Malformed input: penalize trust slightly
+                    _, new_trust = await _adjust_trust(redis, trust_sha, client_id, -2)
+                    await _send(websocket, {
+                        "ok": False,
+                        "error": "invalid_json",
+                        "trustScore": new_trust,
+                    })
+                    continue
+                if _is_keepalive(payload):
+                    # Nothing to score or audit
+                    continue
+                raws.append(data)
+                payloads.append(payload)
+            if not payloads:
                 continue
 
-            X, extras = engine.extract_features(payload)
-            label, risk = engine.predict(X)
+            features_payload = payloads[0] if len(payloads) == 1 else merge_payloads(payloads)
+            X, extras = engine.extract_features(features_payload, out=xbuf)
+            if predict_executor is not None and X.any():
+                # xbuf is not touched again until this await returns; empty
+                # frames hit predict()'s cached result, so they stay inline
+                label, risk = await loop.run_in_executor(predict_executor, engine.predict, X)
+            else:
+                label, risk = engine.predict(X)
             is_bot = engine.detect_bot(extras)
 
-            prev_trust = await _get_trust(redis, client_id)
-            usb_event = payload.get("usbEvent")
-            if usb_event:
-                delta = -20 if usb_event.get("isSuspicious") else -5
-            elif is_bot:
-                delta = -30
-            elif label == -1:
-                delta = -10
-            else:
-                delta = +1
-            trust = await _adjust_trust(redis, client_id, delta)
-
-            # Encrypt and store audit log
-            ciphertext = fernet.encrypt(json.dumps(payload).encode("utf-8"))
-            async with AsyncSessionLocal() as session:  # type: AsyncSession
-                await session.execute(
-                    insert(AuditLog).values(
-                        user_id=None,
-                        client_id=client_id,
-                        risk_score=float(risk),
-                        encrypted_data=ciphertext,
-                    )
-                )
-                await session.commit()
-
-            focus_level = (
-                "High" if risk < 30 else "Medium" if risk < 60 else "Distracted"
-            )
-            await websocket.send_json({
+            usb_events = [p["usbEvent"] for p in payloads if p.get("usbEvent")]
+            usb_suspicious = any(bool(e.get("isSuspicious")) for e in usb_events)
+            delta = TRUST_DELTAS[(bool(usb_events), usb_suspicious, bool(is_bot), label == -1)]
+            prev_trust, trust = await _adjust_trust(redis, trust_sha, client_id, delta)
+
+            # Encrypt and hand off to the batched audit writer. The received
+            # frames are already canonical JSON; a batch is stored as an array.
+            plaintext = raws[0] if len(raws) == 1 else "[" + ",".join(raws) + "]"
+            ciphertext = cipher.encrypt(plaintext.encode("utf-8"))
+            await audit_queue.put({
+                "user_id": None,
+                "client_id": client_id,
+                "risk_score": float(risk),
+                "encrypted_data": ciphertext,
+            })
+
+            focus_level = _FOCUS_LEVELS[(risk >= 30) + (risk >= 60)]
+            await _send(websocket, {
                 "ok": True,
                 "currentActivity": "Monitoring",
                 "focusLevel": focus_level,
@@ -138,7 +220,10 @@ async def stream(websocket: WebSocket, client_id: str) -> None:
                 "detectedApps": [],
                 "features": extras,
             })
+        # Surface receive errors other than a disconnect (e.g. a binary frame)
+        if reader_task.done() and not reader_task.cancelled() and reader_task.exception():
+            raise reader_task.exception()
     except WebSocketDisconnect:
         pass
     finally:
-        decay_task.cancel()
\ No newline at end of file
+        reader_task.cancel()
@@ -40,12 +40,22 @@ def _get_env_list(key: str, default: List[str]) -> List[str]:
 class Settings:
     APP_NAME: str = _get_env("APP_NAME", "SENTINEL // CORE")
     DATABASE_URL: str = _get_env("DATABASE_URL", "sqlite+aiosqlite:///./sentinel_core.db")
+    DB_POOL_SIZE: int = _get_env_int("DB_POOL_SIZE", 20)
+    DB_MAX_OVERFLOW: int = _get_env_int("DB_MAX_OVERFLOW", 20)
+    DB_POOL_RECYCLE_SECONDS: int = _get_env_int("DB_POOL_RECYCLE_SECONDS", 1800)
     REDIS_URL: str = _get_env("REDIS_URL", "redis://localhost:6379/0")
     REDIS_PASSWORD: Optional[str] = os.environ.get("REDIS_PASSWORD")
+    REDIS_MAX_CONNECTIONS: int = _get_env_int("REDIS_MAX_CONNECTIONS", 64)
     JWT_SECRET: str = _get_env("JWT_SECRET", "change-me-in-prod")
     JWT_ALGORITHM: str = _get_env("JWT_ALGORITHM", "HS256")
     ACCESS_TOKEN_EXPIRE_MINUTES: int = _get_env_int("ACCESS_TOKEN_EXPIRE_MINUTES", 60)
+    TOKEN_CACHE_SIZE: int = _get_env_int("TOKEN_CACHE_SIZE", 10000)
+    TOKEN_CACHE_TTL_SECONDS: float = _get_env_float("TOKEN_CACHE_TTL_SECONDS", 60.0)
+    USER_CACHE_SIZE: int = _get_env_int("USER_CACHE_SIZE", 10000)
+    USER_CACHE_TTL_SECONDS: float = _get_env_float("USER_CACHE_TTL_SECONDS", 60.0)
+    BCRYPT_ROUNDS: int = _get_env_int("BCRYPT_ROUNDS", 12)
     FERNET_KEY: Optional[str] = os.environ.get("FERNET_KEY")
+    AUDIT_CIPHER: str = _get_env("AUDIT_CIPHER", "aesgcm").lower()
     CORS_ORIGINS: List[str] = _get_env_list(
         "CORS_ORIGINS",
         [
@@ -62,6 +72,20 @@ class Settings:
     TRUST_MAX_SCORE: int = _get_env_int("TRUST_MAX_SCORE", 100)
     BOT_LINEAR_MOUSE_VELOCITY_THRESHOLD: float = _get_env_float("BOT_LINEAR_MOUSE_VELOCITY_THRESHOLD", 800.0)
     BOT_ANGULAR_VELOCITY_EPSILON: float = _get_env_float("BOT_ANGULAR_VELOCITY_EPSILON", 0.05)
+    # IsolationForest scoring: auto|numba (Numba kernel, sklearn if missing),
+    # onnx (onnxruntime; needs skl2onnx + onnxruntime) or sklearn
+    ML_BACKEND: str = _get_env("ML_BACKEND", "auto").lower()
+    # Threads scoring the IsolationForest off the event loop; 0 scores inline,
+    # -1 scores inline on the Numba kernel and uses min(4, cpus) threads otherwise
+    PREDICT_WORKERS: int = _get_env_int("PREDICT_WORKERS", -1)
+    # Uvicorn worker processes for `python main.py`. More than one needs a
+    # shared FERNET_KEY and a reachable Redis, otherwise one worker is used
+    WORKERS: int = _get_env_int("WORKERS", 1)
+    WS_COALESCE_MAX_FRAMES: int = _get_env_int("WS_COALESCE_MAX_FRAMES", 32)
+    AUDIT_QUEUE_MAXSIZE: int = _get_env_int("AUDIT_QUEUE_MAXSIZE", 10000)
+    AUDIT_BATCH_SIZE: int = _get_env_int("AUDIT_BATCH_SIZE", 256)
+    AUDIT_FLUSH_MS: int = _get_env_int("AUDIT_FLUSH_MS", 50)
+    AUDIT_WRITE_RETRIES: int = _get_env_int("AUDIT_WRITE_RETRIES", 5)
 
 
 settings = Settings()
\ No newline at end of file
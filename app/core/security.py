@@ -5,35 +5,51 @@ We use two layers of security primitives:
 
 1) JWT for stateless authentication: A signed token (HS256) asserts identity
    without persisting session material server-side, reducing attack surface.
-2) Fernet for at-rest encryption of raw behavioral payloads: Even if an attacker
-   gains database access, they only see ciphertext. This is a concrete
-   privacy-preserving measure mandated by the thesis: sensitive inputs
-   (keystrokes/mouse telemetry) must be unreadable without the encryption key.
-
-We also rely on strong password hashing (bcrypt via passlib) to ensure
-password material is never stored in reversible form.
+2) Authenticated encryption of raw behavioral payloads at rest (AES-256-GCM,
+   or Fernet when AUDIT_CIPHER=fernet): Even if an attacker gains database
+   access, they only see ciphertext. This is a concrete privacy-preserving
+   measure mandated by the thesis: sensitive inputs (keystrokes/mouse
+   telemetry) must be unreadable without the encryption key.
+
+We also rely on strong password hashing (bcrypt) to ensure password material
+is never stored in reversible form. Legacy pbkdf2_sha256 hashes are still
+verified through passlib.
 """
 
+import base64
+import os
 import time
-from datetime import datetime, timedelta
+from hashlib import blake2b
 from typing import Any, Dict, Optional
 
+import bcrypt
 import jwt
+from cachetools import TTLCache
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from passlib.context import CryptContext
 
 from .config import settings
 
 
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+# Only used to verify hashes created before the switch to direct bcrypt calls
+legacy_pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+
+# bcrypt only consumes the first 72 bytes of a password
+_BCRYPT_MAX_BYTES = 72
 
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    salt = bcrypt.gensalt(settings.BCRYPT_ROUNDS)
+    return bcrypt.hashpw(password.encode("utf-8")[:_BCRYPT_MAX_BYTES], salt).decode("ascii")
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    if hashed_password.startswith("$pbkdf2-sha256$"):
+        return legacy_pwd_context.verify(plain_password, hashed_password)
+    return bcrypt.checkpw(plain_password.encode("utf-8")[:_BCRYPT_MAX_BYTES], hashed_password.encode("ascii"))
 
 
 def create_access_token(subject: str, expires_minutes: Optional[int] = None) -> str:
@@ -44,38 +60,94 @@ def create_access_token(subject: str, expires_minutes: Optional[int] = None) ->
     Only the subject and exp are included, limiting exposure if a token is
     intercepted.
     """
-    expire_delta = timedelta(minutes=expires_minutes or settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    now = datetime.utcnow()
+    # Epoch seconds straight from time.time(); mktime() on a naive utcnow()
+    # treated UTC as local time and skewed iat/exp on non-UTC hosts.
+    now = int(time.time())
     payload: Dict[str, Any] = {
         "sub": subject,
-        "iat": int(time.mktime(now.timetuple())),
-        "exp": int(time.mktime((now + expire_delta).timetuple())),
+        "iat": now,
+        "exp": now + (expires_minutes or settings.ACCESS_TOKEN_EXPIRE_MINUTES) * 60,
     }
     return jwt.encode(payload, settings.JWT_SECRET, algorithm=settings.JWT_ALGORITHM)
 
 
+# Verified claims keyed by a digest of the exact token string. A hit means
+# these bytes already passed signature verification; exp is still re-checked.
+_token_cache: TTLCache = TTLCache(maxsize=settings.TOKEN_CACHE_SIZE, ttl=settings.TOKEN_CACHE_TTL_SECONDS)
+
+
 def decode_token(token: str) -> Dict[str, Any]:
-    return jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
+    key = blake2b(token.encode("utf-8"), digest_size=16).digest()
+    claims = _token_cache.get(key)
+    if claims is not None:
+        if claims.get("exp", 0) > time.time():
+            return claims
+        # Expired: drop it now rather than holding it until the TTL lapses
+        _token_cache.pop(key, None)
+    claims = jwt.decode(token, settings.JWT_SECRET, algorithms=[settings.JWT_ALGORITHM])
+    _token_cache[key] = claims
+    return claims
 
 
-_fernet: Optional[Fernet] = None
+_fernet_key: Optional[bytes] = None
+_audit_cipher: Optional["AuditCipher"] = None
 
 
-def get_fernet() -> Fernet:
+def _get_fernet_key() -> bytes:
     """
-    Return a process-wide Fernet instance. If no key is provided via env,
-    a random key is generated, which is suitable for ephemeral dev sessions.
+    Return the process-wide audit key. If no key is provided via env, a
+    random key is generated, which is suitable for ephemeral dev sessions.
 
     Cybersecurity Thesis: In production, FERNET_KEY must be supplied via a
     secret management system (vault/KMS). Keys must be rotated periodically
     to minimize the window of exposure.
     """
-    global _fernet
-    if _fernet is not None:
-        return _fernet
-    if settings.FERNET_KEY:
-        key = settings.FERNET_KEY.encode()
-    else:
-        key = Fernet.generate_key()
-    _fernet = Fernet(key)
-    return _fernet
\ No newline at end of file
+    global _fernet_key
+    if _fernet_key is None:
+        _fernet_key = settings.FERNET_KEY.encode() if settings.FERNET_KEY else Fernet.generate_key()
+    return _fernet_key
+
+
+# Leading byte of AES-GCM audit blobs. Fernet tokens always start with "g"
+# (base64 of the 0x80 version byte), so the two formats never collide.
+_AESGCM_TAG = b"\x01"
+_AESGCM_NONCE_SIZE = 12
+
+
+class AuditCipher:
+    """
+    Encrypts audit payloads as ``0x01 || nonce || AES-256-GCM(ciphertext+tag)``
+    and decrypts both that format and legacy Fernet tokens. AES-GCM skips
+    Fernet's CBC + HMAC + base64 pipeline while remaining authenticated.
+    """
+
+    def __init__(self, fernet_key: bytes, use_fernet: bool = False) -> None:
+        self._fernet = Fernet(fernet_key)
+        # Derive a dedicated AES key so the Fernet key material is not reused
+        # verbatim under a different algorithm
+        aes_key = HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None, info=b"sentinel-audit-aesgcm"
+        ).derive(base64.urlsafe_b64decode(fernet_key))
+        self._aead = AESGCM(aes_key)
+        self._use_fernet = use_fernet
+
+    def encrypt(self, data: bytes) -> bytes:
+        if self._use_fernet:
+            return self._fernet.encrypt(data)
+        nonce = os.urandom(_AESGCM_NONCE_SIZE)
+        return _AESGCM_TAG + nonce + self._aead.encrypt(nonce, data, None)
+
+    def decrypt(self, blob: bytes) -> bytes:
+        if blob[:1] == _AESGCM_TAG:
+            nonce = blob[1:1 + _AESGCM_NONCE_SIZE]
+            return self._aead.decrypt(nonce, blob[1 + _AESGCM_NONCE_SIZE:], None)
+        return self._fernet.decrypt(blob)
+
+
+def get_audit_cipher() -> AuditCipher:
+    """Return the process-wide audit cipher, keyed from FERNET_KEY."""
+    global _audit_cipher
+    if _audit_cipher is not None:
+        return _audit_cipher
+    _audit_cipher = AuditCipher(_get_fernet_key(), use_fernet=settings.AUDIT_CIPHER == "fernet")
+    return _audit_cipher
@@ -3,13 +3,15 @@ Cybersecurity Thesis Context:
 
 We enforce separation of concerns: identities (User), ML artifacts
 (BiometricProfile), and audit trails (AuditLog) are isolated. Sensitive raw
-payloads in the AuditLog are encrypted with Fernet before persistence.
-This satisfies "privacy-preservation at rest" while still enabling forensic
-analysis upon authorized decryption.
+payloads are encrypted before persistence and stored apart from the audit
+metadata (AuditLogBlob), so dashboard scans over time/client/risk never read
+ciphertext pages. This satisfies "privacy-preservation at rest" while still
+enabling forensic analysis upon authorized decryption.
 """
 
 from __future__ import annotations
 
+import asyncio
 from typing import AsyncIterator, Optional
 
 from sqlalchemy import (
@@ -20,10 +22,15 @@ from sqlalchemy import (
     ForeignKey,
     Float,
     DateTime,
+    Index,
     func,
+    inspect,
     text,
     select,
 )
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.orm import declarative_base, relationship, Mapped, mapped_column
 from sqlalchemy.ext.asyncio import (
     create_async_engine,
@@ -37,8 +44,23 @@ from app.core.config import settings
 Base = declarative_base()
 
 
+def _pool_kwargs(url: str) -> dict:
+    # In-memory SQLite runs on a StaticPool, which takes no sizing arguments.
+    # File-backed aiosqlite otherwise defaults to NullPool (a new connection
+    # per checkout), so the queue pool is selected explicitly.
+    u = make_url(url)
+    if u.get_backend_name() == "sqlite" and u.database in (None, "", ":memory:"):
+        return {}
+    return {
+        "poolclass": AsyncAdaptedQueuePool,
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_recycle": settings.DB_POOL_RECYCLE_SECONDS,
+    }
+
+
 async_engine = create_async_engine(
-    settings.DATABASE_URL, echo=False, pool_pre_ping=True
+    settings.DATABASE_URL, echo=False, pool_pre_ping=True, **_pool_kwargs(settings.DATABASE_URL)
 )
 AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
 
@@ -66,21 +88,68 @@ class BiometricProfile(Base):
 
 
 class AuditLog(Base):
-    __tablename__ = "audit_logs"
+    __tablename__ = "audit_logs_meta"
+    __table_args__ = (Index("ix_audit_logs_meta_client_ts", "client_id", "timestamp"),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[Optional[int]] = mapped_column(ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
-    client_id: Mapped[Optional[str]] = mapped_column(String(128), index=True, nullable=True)
+    client_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
     timestamp: Mapped[str] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
     risk_score: Mapped[float] = mapped_column(Float, nullable=False)
-    encrypted_data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
 
     user: Mapped[Optional[User]] = relationship("User", back_populates="logs")
+    blob: Mapped[AuditLogBlob] = relationship("AuditLogBlob", back_populates="log", uselist=False)
+
+
+class AuditLogBlob(Base):
+    __tablename__ = "audit_logs_blob"
+
+    id: Mapped[int] = mapped_column(ForeignKey("audit_logs_meta.id", ondelete="CASCADE"), primary_key=True)
+    encrypted_data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+    log: Mapped[AuditLog] = relationship("AuditLog", back_populates="blob")
+
+
+def _migrate_legacy_audit_logs(conn) -> None:
+    """
+    Copy a pre-split ``audit_logs`` table into audit_logs_meta/audit_logs_blob
+    and drop it, in the caller's transaction. Ids are kept; if the split
+    tables already hold rows, legacy ids are shifted past them so both sets
+    survive.
+    """
+    if not inspect(conn).has_table("audit_logs"):
+        return
+    offset = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM audit_logs_meta")).scalar_one()
+    conn.execute(
+        text(
+            "INSERT INTO audit_logs_meta (id, user_id, client_id, timestamp, risk_score) "
+            "SELECT id + :offset, user_id, client_id, timestamp, risk_score FROM audit_logs"
+        ),
+        {"offset": offset},
+    )
+    conn.execute(
+        text(
+            "INSERT INTO audit_logs_blob (id, encrypted_data) "
+            "SELECT id + :offset, encrypted_data FROM audit_logs"
+        ),
+        {"offset": offset},
+    )
+    conn.execute(text("DROP TABLE audit_logs"))
 
 
 async def init_db() -> None:
-    async with async_engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Several workers may start against a fresh database at once; the loser
+    # of a CREATE TABLE race retries and checkfirst skips the existing tables
+    for attempt in range(3):
+        try:
+            async with async_engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.run_sync(_migrate_legacy_audit_logs)
+            return
+        except OperationalError:
+            if attempt == 2:
+                raise
+            await asyncio.sleep(0.1)
 
 
 async def get_session() -> AsyncIterator[AsyncSession]:
@@ -0,0 +1,101 @@
+"""
+Cybersecurity Thesis Context:
+
+Encrypted audit rows are produced on every telemetry frame. Committing each
+row individually serializes all connections on database locks, so producers
+enqueue already-encrypted rows and a single background writer persists them
+in batches. Ciphertext is produced before enqueueing; plaintext telemetry is
+never buffered here.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.core.config import settings
+from app.core.logging import get_logger
+from app.db.models import AuditLog, AuditLogBlob, async_engine
+
+
+async def _next_batch(queue: asyncio.Queue) -> List[Dict[str, Any]]:
+    loop = asyncio.get_running_loop()
+    rows = [await queue.get()]
+    deadline = loop.time() + settings.AUDIT_FLUSH_MS / 1000.0
+    while len(rows) < settings.AUDIT_BATCH_SIZE:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            rows.append(await asyncio.wait_for(queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+    return rows
+
+
+async def _write(conn: AsyncConnection, rows: List[Dict[str, Any]]) -> None:
+    # Metadata and ciphertext live in separate tables; RETURNING hands back
+    # the generated ids in parameter order so blobs can be keyed to them.
+    result = await conn.execute(
+        insert(AuditLog).returning(AuditLog.id, sort_by_parameter_order=True),
+        [{k: v for k, v in row.items() if k != "encrypted_data"} for row in rows],
+    )
+    ids = result.scalars().all()
+    await conn.execute(
+        insert(AuditLogBlob),
+        [{"id": log_id, "encrypted_data": row["encrypted_data"]} for log_id, row in zip(ids, rows)],
+    )
+    await conn.commit()
+
+
+async def _discard(conn: Optional[AsyncConnection]) -> None:
+    if conn is not None:
+        try:
+            await conn.close()
+        except Exception:
+            pass
+
+
+async def audit_writer(queue: asyncio.Queue) -> None:
+    """
+    Drain ``queue`` forever, writing up to AUDIT_BATCH_SIZE rows per
+    transaction. A batch is flushed once it is full or AUDIT_FLUSH_MS after
+    its first row arrived, whichever comes first.
+
+    The writer keeps one connection checked out for its lifetime so flushes
+    skip the pool checkout and pre-ping. A failed flush is retried on a new
+    connection up to AUDIT_WRITE_RETRIES times, with backoff, before the batch
+    is dropped.
+    """
+    conn: Optional[AsyncConnection] = None
+    try:
+        while True:
+            rows = await _next_batch(queue)
+            # The held connection skips pre-ping, so the first flush after it
+            # went stale fails, and SQLite reports lock contention between
+            # workers as an error; retry the same rows on a fresh connection
+            attempts = settings.AUDIT_WRITE_RETRIES + 1
+            for attempt in range(attempts):
+                try:
+                    if conn is None:
+                        conn = await async_engine.connect()
+                    await _write(conn, rows)
+                    break
+                except Exception as e:
+                    get_logger().error(f"audit_flush_error rows={len(rows)} attempt={attempt + 1} error={e}")
+                    await _discard(conn)
+                    conn = None
+                    if attempt + 1 < attempts:
+                        await asyncio.sleep(min(0.05 * 2 ** attempt, 2.0))
+            else:
+                get_logger().error(f"audit_rows_dropped rows={len(rows)}")
+            # Ack only once the batch is committed (or given up on), so
+            # shutdown's queue.join() waits for in-flight retries
+            for _ in rows:
+                queue.task_done()
+    finally:
+        if conn is not None:
+            await conn.close()
@@ -18,8 +18,9 @@ for humans.
 
 from __future__ import annotations
 
-import math
-from typing import Dict, List, Tuple, Optional
+import io
+from collections import defaultdict, deque
+from typing import DefaultDict, Deque, Dict, List, Tuple, Optional
 
 # Lazy imports to improve startup resilience in constrained environments
 try:
@@ -29,30 +30,228 @@ except Exception:  # pragma: no cover
 
 try:
     from sklearn.ensemble import IsolationForest  # type: ignore
-    from joblib import dumps as joblib_dumps, loads as joblib_loads  # type: ignore
 except Exception:  # pragma: no cover
     IsolationForest = None  # type: ignore
-    joblib_dumps = None  # type: ignore
-    joblib_loads = None  # type: ignore
+
+try:
+    import joblib  # type: ignore
+except Exception:  # pragma: no cover
+    joblib = None  # type: ignore
+
+try:
+    from numba import njit  # type: ignore
+except Exception:  # pragma: no cover
+    njit = None  # type: ignore
 
 from app.core.config import settings
 
 
+N_FEATURES = 4
+
+
+def _average_path_length(n_samples: np.ndarray) -> np.ndarray:
+    """c(n): average path length of an unsuccessful BST search over n points."""
+    n = np.asarray(n_samples, dtype=np.float64)
+    out = np.zeros_like(n)
+    out[n == 2] = 1.0
+    big = n > 2
+    out[big] = 2.0 * (np.log(n[big] - 1.0) + np.euler_gamma) - 2.0 * (n[big] - 1.0) / n[big]
+    return out
+
+
+def _forest_mean_depth(feature, threshold, left, right, leaf_depth, x) -> float:
+    """
+    Mean isolation depth of ``x`` across a forest stored as padded
+    (n_trees, max_nodes) arrays. ``leaf_depth`` already includes the c(n)
+    correction for the samples left unsplit at each leaf.
+    """
+    n_trees = feature.shape[0]
+    total = 0.0
+    for t in range(n_trees):
+        node = 0
+        while left[t, node] != -1:
+            if x[feature[t, node]] <= threshold[t, node]:
+                node = left[t, node]
+            else:
+                node = right[t, node]
+        total += leaf_depth[t, node]
+    return total / n_trees
+
+
+_forest_mean_depth_jit = njit(cache=True, nogil=True)(_forest_mean_depth) if njit is not None else None
+
+
+def _column(values, dtype, n: int) -> np.ndarray:
+    return np.asarray(values if values is not None else (), dtype=dtype)[:n]
+
+
+def _column_len(values) -> int:
+    return 0 if values is None else len(values)
+
+
+def payload_columns(payload: Dict) -> Tuple[np.ndarray, ...]:
+    """
+    Return (ks_ts, ks_type, ks_key, mx, my, mt) arrays for a telemetry frame.
+
+    Columnar (preferred) layout, one array per field:
+    {
+      "ks_ts": [1699999999.123, ...], "ks_type": ["keydown"|"keyup", ...], "ks_key": ["A", ...],
+      "mx": [100, ...], "my": [200, ...], "mt": [1699999999.456, ...]
+    }
+
+    Legacy layout, one object per event:
+    {
+      "keystrokes": [ {"type": "keydown"|"keyup", "key": "A", "timestamp": 1699999999.123}, ... ],
+      "mouse": [ {"x": 100, "y": 200, "timestamp": 1699999999.456}, ... ]
+    }
+    """
+    if "ks_ts" in payload or "mt" in payload:
+        # Columns of unequal length are truncated to the shortest one
+        n_ks = min(_column_len(payload.get(k)) for k in ("ks_ts", "ks_type", "ks_key"))
+        n_ms = min(_column_len(payload.get(k)) for k in ("mx", "my", "mt"))
+        return (
+            _column(payload.get("ks_ts"), np.float64, n_ks),
+            _column(payload.get("ks_type"), object, n_ks),
+            _column(payload.get("ks_key"), object, n_ks),
+            _column(payload.get("mx"), np.float64, n_ms),
+            _column(payload.get("my"), np.float64, n_ms),
+            _column(payload.get("mt"), np.float64, n_ms),
+        )
+    ks = payload.get("keystrokes", [])
+    ms = payload.get("mouse", [])
+    n_ks, n_ms = len(ks), len(ms)
+    return (
+        np.fromiter((float(e.get("timestamp", 0)) for e in ks), dtype=np.float64, count=n_ks),
+        np.array([e.get("type") for e in ks], dtype=object),
+        np.array([e.get("key") for e in ks], dtype=object),
+        np.fromiter((float(e.get("x", 0)) for e in ms), dtype=np.float64, count=n_ms),
+        np.fromiter((float(e.get("y", 0)) for e in ms), dtype=np.float64, count=n_ms),
+        np.fromiter((float(e.get("timestamp", 0)) for e in ms), dtype=np.float64, count=n_ms),
+    )
+
+
+def merge_payloads(payloads: List[Dict]) -> Dict[str, np.ndarray]:
+    """
+    Combine several frames into one columnar payload for a single
+    extract_features() call. Events repeated across frames (clients that
+    resend a sliding window) are kept once; arrival order is preserved.
+    """
+    ks_ts, ks_type, ks_key, mx, my, mt = (np.concatenate(c) for c in zip(*map(payload_columns, payloads)))
+    # Keystrokes are identical when (timestamp, type, key) match
+    _, type_code = np.unique(ks_type.astype(str), return_inverse=True)
+    _, key_code = np.unique(ks_key.astype(str), return_inverse=True)
+    _, ks_keep = np.unique(np.column_stack([ks_ts, type_code, key_code]), axis=0, return_index=True)
+    _, ms_keep = np.unique(np.column_stack([mt, mx, my]), axis=0, return_index=True)
+    ks_keep.sort()
+    ms_keep.sort()
+    return {
+        "ks_ts": ks_ts[ks_keep],
+        "ks_type": ks_type[ks_keep],
+        "ks_key": ks_key[ks_keep],
+        "mx": mx[ms_keep],
+        "my": my[ms_keep],
+        "mt": mt[ms_keep],
+    }
+
+
 class BiometricEngine:
     def __init__(self) -> None:
         self.model: Optional[IsolationForest] = None  # type: ignore
+        # Flattened forest for the Numba scoring path; None => use sklearn
+        self._forest: Optional[Tuple[np.ndarray, ...]] = None
+        # onnxruntime session when ML_BACKEND=onnx
+        self._onnx_sess = None
+        # Cached prediction for the all-zero vector (frames without telemetry)
+        self._empty_result: Optional[Tuple[int, float]] = None
 
     def load_model_blob(self, blob: bytes) -> None:
-        if joblib_loads is None:
+        if joblib is None:
             raise RuntimeError("Joblib not available to load model blob")
-        self.model = joblib_loads(blob)  # type: ignore
+        self.model = joblib.load(io.BytesIO(blob))  # type: ignore
+        self._model_ready()
+
+    def _model_ready(self) -> None:
+        backend = settings.ML_BACKEND
+        self._forest = None
+        self._onnx_sess = None
+        if backend in ("auto", "numba"):
+            self._compile_forest()
+        elif backend == "onnx":
+            self._compile_onnx()
+        self._empty_result = self._score(np.zeros(N_FEATURES, dtype=np.float32))
+
+    def _compile_onnx(self) -> None:
+        """
+        Convert the fitted forest to ONNX and open a single-threaded
+        onnxruntime session for it. Leaves the sklearn path in place when
+        skl2onnx/onnxruntime are not installed.
+        """
+        try:
+            import onnxruntime as ort  # type: ignore
+            from skl2onnx import convert_sklearn  # type: ignore
+            from skl2onnx.common.data_types import FloatTensorType  # type: ignore
+        except Exception:  # pragma: no cover
+            return
+        onnx_model = convert_sklearn(
+            self.model,
+            initial_types=[("X", FloatTensorType([None, N_FEATURES]))],
+            target_opset={"": 17, "ai.onnx.ml": 3},
+        )
+        opts = ort.SessionOptions()
+        # One row per call: intra-op threading only adds dispatch latency
+        opts.intra_op_num_threads = 1
+        opts.inter_op_num_threads = 1
+        self._onnx_sess = ort.InferenceSession(
+            onnx_model.SerializeToString(), sess_options=opts, providers=["CPUExecutionProvider"]
+        )
+
+    @property
+    def scores_inline(self) -> bool:
+        """True when scoring runs the Numba kernel, which is cheaper than a thread hop."""
+        return self._forest is not None
+
+    def _compile_forest(self) -> None:
+        """
+        Copy the fitted trees into padded (n_trees, max_nodes) arrays so
+        _forest_mean_depth_jit can score a sample without sklearn dispatch.
+        """
+        self._forest = None
+        if _forest_mean_depth_jit is None or self.model is None:
+            return
+        trees = [est.tree_ for est in self.model.estimators_]
+        n_nodes = max(t.node_count for t in trees)
+        shape = (len(trees), n_nodes)
+        feature = np.zeros(shape, dtype=np.int64)
+        threshold = np.zeros(shape, dtype=np.float64)
+        left = np.full(shape, -1, dtype=np.int64)
+        right = np.full(shape, -1, dtype=np.int64)
+        leaf_depth = np.zeros(shape, dtype=np.float64)
+        for i, (tree, feats) in enumerate(zip(trees, self.model.estimators_features_)):
+            n = tree.node_count
+            is_split = tree.children_left[:n] != -1
+            # Trees index a (possibly permuted) feature subset; map back to X columns
+            feature[i, :n] = np.where(is_split, np.asarray(feats)[np.maximum(tree.feature[:n], 0)], 0)
+            threshold[i, :n] = tree.threshold[:n]
+            left[i, :n] = tree.children_left[:n]
+            right[i, :n] = tree.children_right[:n]
+            depth = np.zeros(n, dtype=np.float64)
+            for node in range(n):  # parents always precede children
+                if is_split[node]:
+                    depth[tree.children_left[node]] = depth[node] + 1.0
+                    depth[tree.children_right[node]] = depth[node] + 1.0
+            leaf_depth[i, :n] = depth + _average_path_length(tree.n_node_samples[:n])
+        self._forest = (feature, threshold, left, right, leaf_depth)
+        self._depth_norm = float(_average_path_length(np.array([self.model.max_samples_]))[0])
+        self._offset = float(self.model.offset_)
 
     def dump_model_blob(self) -> bytes:
         if self.model is None:
             raise RuntimeError("Model not trained")
-        if joblib_dumps is None:
+        if joblib is None:
             raise RuntimeError("Joblib not available to dump model blob")
-        return joblib_dumps(self.model)  # type: ignore
+        buf = io.BytesIO()
+        joblib.dump(self.model, buf)  # type: ignore
+        return buf.getvalue()
 
     def fit_baseline(self, n_samples: int = 512) -> None:
         """
@@ -72,77 +271,77 @@ class BiometricEngine:
         avg_dwell = rng.normal(loc=90, scale=30, size=n_samples)    # ms
         rhythm_var = rng.gamma(shape=2.0, scale=25.0, size=n_samples)
         mouse_vel = rng.normal(loc=350, scale=150, size=n_samples)  # px/s
-        X = np.vstack([avg_flight, avg_dwell, rhythm_var, mouse_vel]).T
+        # float32 matches what the trees compare against at predict time
+        X = np.vstack([avg_flight, avg_dwell, rhythm_var, mouse_vel]).T.astype(np.float32)
         self.model = IsolationForest(n_estimators=200, contamination=0.05, random_state=42)  # type: ignore
         self.model.fit(X)  # type: ignore
+        self._model_ready()
+
+    @staticmethod
+    def feature_buffer() -> np.ndarray:
+        """Allocate a reusable ``out`` buffer for extract_features()."""
+        return np.empty(N_FEATURES, dtype=np.float32)
 
-    def extract_features(self, payload: Dict) -> Tuple[np.ndarray, Dict[str, float]]:
+    def extract_features(
+        self, payload: Dict, out: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, Dict[str, float]]:
         """
-        Convert raw keystrokes/mouse events into feature vector:
+        Convert raw keystrokes/mouse events into a float32 feature vector:
         [AvgFlightTime, AvgDwellTime, RhythmVariance, MouseVelocity]
 
-        Expected payload structure:
-        {
-          "keystrokes": [ {"type": "keydown"|"keyup", "key": "A", "timestamp": 1699999999.123}, ... ],
-          "mouse": [ {"x": 100, "y": 200, "timestamp": 1699999999.456}, ... ]
-        }
+        Accepts either payload layout understood by payload_columns(). When
+        ``out`` (see feature_buffer()) is given the vector is written into it
+        and returned, so callers must not keep X across calls.
         """
         if np is None:
             raise RuntimeError("NumPy is not available; please install dependencies")
-        ks = payload.get("keystrokes", [])
-        ms = payload.get("mouse", [])
+        ks_ts, ks_type, ks_key, xs, ys, ts = payload_columns(payload)
+
+        # Event-type masks are computed once and shared by dwell and flight
+        is_down = ks_type == "keydown"
+        is_up = ks_type == "keyup"
 
-        # Dwell time: keydown -> keyup duration
-        down_times: Dict[str, List[float]] = {}
+        # Dwell time: keydown -> keyup duration, FIFO pairing per key in time
+        # order. deque.popleft keeps this linear even for long held-key runs.
+        order = np.argsort(ks_ts, kind="stable")
+        down_times: DefaultDict[str, Deque[float]] = defaultdict(deque)
         dwell_durations: List[float] = []
-        for e in ks:
-            t = float(e.get("timestamp", 0))
-            ty = e.get("type")
-            k = e.get("key")
-            if ty == "keydown":
-                down_times.setdefault(k, []).append(t)
-            elif ty == "keyup":
-                arr = down_times.get(k)
-                if arr:
-                    start = arr.pop(0)
-                    dwell_durations.append(max(0.0, (t - start) * 1000.0))  # ms
-
-        avg_dwell = float(np.mean(dwell_durations)) if dwell_durations else 0.0
+        for t, down, up, k in zip(
+            ks_ts[order].tolist(), is_down[order].tolist(), is_up[order].tolist(), ks_key[order].tolist()
+        ):
+            if down:
+                down_times[k].append(t)
+            elif up:
+                pending = down_times.get(k)
+                if pending:
+                    dwell_durations.append(t - pending.popleft())
+
+        dwell = np.asarray(dwell_durations, dtype=np.float64) * 1000.0  # ms, non-negative after sort
+        avg_dwell = float(dwell.mean()) if dwell.size else 0.0
 
         # Flight time: time between consecutive keydown events
-        keydown_ts: List[float] = [float(e.get("timestamp", 0)) for e in ks if e.get("type") == "keydown"]
-        keydown_ts.sort()
-        flights = [max(0.0, (b - a) * 1000.0) for a, b in zip(keydown_ts[:-1], keydown_ts[1:])]
-        avg_flight = float(np.mean(flights)) if flights else 0.0
-        rhythm_var = float(np.var(flights)) if flights else 0.0
+        flights = np.diff(np.sort(ks_ts[is_down])) * 1000.0  # ms, non-negative after sort
+        if flights.size:
+            avg_flight = float(flights.mean())
+            # Population variance (ddof=0) reusing the mean computed above
+            dev = flights - avg_flight
+            rhythm_var = float(np.dot(dev, dev)) / flights.size
+        else:
+            avg_flight = 0.0
+            rhythm_var = 0.0
 
         # Mouse velocity and angular velocity
-        mouse_velocities: List[float] = []
-        angle_changes: List[float] = []
-        for (a, b) in zip(ms[:-1], ms[1:]):
-            dt = max(1e-6, float(b.get("timestamp", 0)) - float(a.get("timestamp", 0)))
-            dx = float(b.get("x", 0)) - float(a.get("x", 0))
-            dy = float(b.get("y", 0)) - float(a.get("y", 0))
-            dist = math.hypot(dx, dy)
-            mouse_velocities.append(dist / dt)  # px/s
-            angle_a = math.atan2(dy, dx)
-            # Use previous segment when available for angle delta
-            if len(angle_changes) > 0:
-                prev_angle = angle_changes[-1]
-                angle_changes.append(abs(angle_a - prev_angle))
-            else:
-                angle_changes.append(angle_a)
-
-        avg_mouse_vel = float(np.mean(mouse_velocities)) if mouse_velocities else 0.0
-        # Approximate angular velocity as mean absolute angle change per segment
-        if len(angle_changes) > 1:
-            # remove the initial angle value placeholder
-            diffs = [abs(angle_changes[i] - angle_changes[i - 1]) for i in range(1, len(angle_changes))]
-            angular_velocity = float(np.mean(diffs))
-        else:
-            angular_velocity = 0.0
+        dx = np.diff(xs)
+        dy = np.diff(ys)
+        dt = np.maximum(np.diff(ts), 1e-6)
+        mouse_velocities = np.hypot(dx, dy) / dt  # px/s
+        avg_mouse_vel = float(mouse_velocities.mean()) if mouse_velocities.size else 0.0
+        # Approximate angular velocity as mean absolute heading change per segment
+        angle_changes = np.abs(np.diff(np.arctan2(dy, dx)))
+        angular_velocity = float(angle_changes.mean()) if angle_changes.size else 0.0
 
-        X = np.array([avg_flight, avg_dwell, rhythm_var, avg_mouse_vel], dtype=float)
+        X = out if out is not None else self.feature_buffer()
+        X[:] = (avg_flight, avg_dwell, rhythm_var, avg_mouse_vel)
         extras = {
             "avg_flight": avg_flight,
             "avg_dwell": avg_dwell,
@@ -161,9 +360,26 @@ class BiometricEngine:
         if IsolationForest is None or self.model is None:
             # Fallback: neutral label and moderate risk
             return 1, 50.0
-        # decision_function: higher => normal, lower => anomalous
-        score = float(self.model.decision_function([X])[0])  # type: ignore
-        label = int(self.model.predict([X])[0])  # type: ignore
+        if self._empty_result is not None and not X.any():
+            # Empty/tiny frames all produce the zero vector; skip the forest
+            return self._empty_result
+        return self._score(X)
+
+    def _score(self, X: np.ndarray) -> Tuple[int, float]:
+        # decision_function: higher => normal, lower => anomalous. predict() is
+        # just its sign, so derive the label instead of walking the forest twice.
+        if self._forest is not None:
+            # Trees compare float32 inputs, matching sklearn's internal cast
+            x = np.asarray(X, dtype=np.float32).ravel()
+            depth = _forest_mean_depth_jit(*self._forest, x)
+            score = -(2.0 ** (-depth / self._depth_norm)) - self._offset
+        elif self._onnx_sess is not None:
+            # "scores" output is decision_function
+            x = np.asarray(X, dtype=np.float32).reshape(1, -1)
+            score = float(self._onnx_sess.run(["scores"], {"X": x})[0].ravel()[0])
+        else:
+            score = float(self.model.decision_function(np.ascontiguousarray(X).reshape(1, -1))[0])  # type: ignore
+        label = 1 if score >= 0 else -1
         # Map score to risk: lower score => higher risk
         risk = max(0.0, min(100.0, 50.0 - score * 100.0))
         return label, risk
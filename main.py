@@ -8,36 +8,59 @@ Entry point for SENTINEL // CORE FastAPI backend.
 - Isolation Forest is used for unsupervised anomaly detection, with additional
   bot heuristics. This better captures distribution irregularities than simple
   averages, which are vulnerable to evasion and lack robust statistical power.
-- All raw event batches are encrypted at rest (Fernet) before storage in the
-  audit log, preserving privacy while enabling authorized forensic review.
+- All raw event batches are encrypted at rest (AES-GCM; Fernet for legacy
+  rows) before storage in the audit log, preserving privacy while enabling
+  authorized forensic review.
 """
 
 from __future__ import annotations
 
 import asyncio
-from typing import Annotated, Optional, List
-
+import base64
+import binascii
+import os
+import re
+import secrets
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Annotated, Any, AsyncIterator, BinaryIO, Callable, Literal, Optional, List
+
+from cachetools import TTLCache
 from fastapi import FastAPI, Depends, HTTPException, status
-from fastapi import Body
+from fastapi import Body, File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 try:
-    from redis.asyncio import from_url as redis_from_url, Redis
+    from redis.asyncio import BlockingConnectionPool, Redis
 except Exception:  # pragma: no cover
-    redis_from_url = None  # type: ignore
+    BlockingConnectionPool = None  # type: ignore
     Redis = None  # type: ignore
-from sqlalchemy import select, insert
+from sqlalchemy import bindparam, select, insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.config import settings
-from app.core.security import create_access_token, decode_token, verify_password, get_password_hash, get_fernet
+from app.core.security import AuditCipher, create_access_token, decode_token, verify_password, get_password_hash, get_audit_cipher
 from app.core.logging import setup_logging, get_logger
-from app.db.models import init_db, get_session, User, BiometricProfile, AuditLog, AsyncSessionLocal
+from app.db.models import init_db, get_session, User, BiometricProfile, AuditLog, AuditLogBlob, AsyncSessionLocal
 from app.services.ml_engine import BiometricEngine
-from app.api.websocket import router as ws_router
+from app.services.audit_writer import audit_writer
+from app.api.websocket import router as ws_router, load_trust_script
+
 
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    await on_startup()
+    try:
+        yield
+    finally:
+        await on_shutdown()
 
-app = FastAPI(title=settings.APP_NAME)
+
+app = FastAPI(title=settings.APP_NAME, lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -51,6 +74,15 @@ app.add_middleware(
 bearer = HTTPBearer(auto_error=True)
 
 
+# Built once at import; SQLAlchemy's compiled cache then reuses it per call
+_USER_BY_NAME = select(User).where(User.username == bindparam("username"))
+
+# Users resolved from verified tokens, keyed by username. Entries are detached
+# instances; they expire after USER_CACHE_TTL_SECONDS so removed users lose
+# access within that window.
+_user_cache: TTLCache = TTLCache(maxsize=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL_SECONDS)
+
+
 async def get_current_user(
     creds: Annotated[HTTPAuthorizationCredentials, Depends(bearer)],
     session: Annotated[AsyncSession, Depends(get_session)],
@@ -60,22 +92,107 @@ async def get_current_user(
         username = payload.get("sub")
         if not username:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid token")
-        result = await session.execute(select(User).where(User.username == username))
+        user = _user_cache.get(username)
+        if user is not None:
+            return user
+        result = await session.execute(_USER_BY_NAME, {"username": username})
         user = result.scalar_one_or_none()
         if not user:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="user not found")
+        _user_cache[username] = user
         return user
     except Exception:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid token")
 
 
+def _redis_url() -> str:
+    url = settings.REDIS_URL
+    if settings.REDIS_PASSWORD and "@" not in url:
+        # inject password for local URLs like redis://localhost:6379/0
+        url = url.replace("redis://", f"redis://:{settings.REDIS_PASSWORD}@")
+    return url
+
+
+def _multi_worker_blocker() -> Optional[str]:
+    # State that is per process unless shared explicitly
+    if not settings.FERNET_KEY:
+        return "FERNET_KEY is unset, so each worker would generate its own audit key"
+    if Redis is None:
+        return "redis is not installed, so each worker would keep its own trust store"
+    try:
+        from redis import Redis as SyncRedis
+
+        client = SyncRedis.from_url(_redis_url(), socket_connect_timeout=2)
+        try:
+            client.ping()
+        finally:
+            client.close()
+    except Exception as e:
+        return f"Redis is unreachable ({e}), so each worker would keep its own trust store"
+    return None
+
+
+# In-memory trust store used when Redis is not configured or unreachable
+class InMemoryPipeline:
+    # Buffers commands and applies them on execute(), like a Redis pipeline
+    def __init__(self, store: "InMemoryTrust") -> None:
+        self._store = store
+        self._ops: list = []
+
+    def unlink(self, *keys: str):
+        self._ops.append((self._store.unlink, keys))
+        return self
+
+    async def execute(self):
+        results = [await op(*args) for op, args in self._ops]
+        self._ops.clear()
+        return results
+
+
+class InMemoryTrust:
+    def __init__(self) -> None:
+        self._store: dict[str, tuple[int, float]] = {}
+
+    async def delete(self, key: str):
+        self._store.pop(key, None)
+
+    async def unlink(self, *keys: str):
+        for key in keys:
+            self._store.pop(key, None)
+
+    def pipeline(self, transaction: bool = True):
+        return InMemoryPipeline(self)
+
+    async def script_load(self, script: str) -> str:
+        return "in-memory"
+
+    async def evalsha(self, sha: str, numkeys: int, key: str, initial, lo, hi, delta, now, decay_seconds, decay_points):
+        # Same decay-adjust-clamp as TRUST_ADJUST_LUA; values are (v, ts)
+        prev, ts = self._store.get(key, (int(initial), now))
+        steps = int((now - ts) // decay_seconds)
+        if steps > 0:
+            prev = max(int(lo), prev - steps * int(decay_points))
+        value = max(int(lo), min(int(hi), prev + int(delta)))
+        self._store[key] = (value, now)
+        return [prev, value]
+
+    async def scan_iter(self, match: str, count: Optional[int] = None):
+        prefix = match.rstrip("*")
+        # Snapshot only the matching keys so concurrent trust updates cannot
+        # invalidate the iterator between yields
+        keys = [k for k in self._store if k.startswith(prefix)]
+        for k in keys:
+            yield k
+
+    async def aclose(self):
+        return
+
+
 # Include WebSocket router
 app.include_router(ws_router)
 
 
-@app.on_event("startup")
 async def on_startup() -> None:
-    from pathlib import Path
     root = Path(".").resolve()
     screenshots_dir = (root / "screenshots")
     logs_dir = (root / "logs")
@@ -86,59 +203,85 @@ async def on_startup() -> None:
     app.state.logger = get_logger()
     await init_db()
     # Initialize trust store (Redis if available, else in-memory)
-    class InMemoryTrust:
-        def __init__(self) -> None:
-            self._store: dict[str, int] = {}
-
-        async def get(self, key: str):
-            return self._store.get(key)
-
-        async def set(self, key: str, value: int):
-            self._store[key] = value
-
-        async def delete(self, key: str):
-            self._store.pop(key, None)
-
-        async def scan_iter(self, match: str):
-            prefix = match.rstrip("*")
-            for k in list(self._store.keys()):
-                if k.startswith(prefix):
-                    yield k
-
-        async def aclose(self):
-            return
-
-    if redis_from_url is not None:
+    app.state.redis_pool = None
+    if Redis is not None:
         try:
-            url = settings.REDIS_URL
-            if settings.REDIS_PASSWORD and "@" not in url:
-                # inject password for local URLs like redis://localhost:6379/0
-                url = url.replace("redis://", f"redis://:{settings.REDIS_PASSWORD}@")
-            app.state.redis = redis_from_url(url, encoding="utf-8", decode_responses=True)
+            url = _redis_url()
+            # Explicit, bounded pool shared by all connections: callers wait
+            # for a free connection instead of opening new ones under load,
+            # and connections are not re-pinged before every command.
+            # Replies are left undecoded: trust values come back as integers
+            # and scanned keys are only passed back to UNLINK.
+            app.state.redis_pool = BlockingConnectionPool.from_url(
+                url,
+                max_connections=settings.REDIS_MAX_CONNECTIONS,
+                health_check_interval=0,
+                socket_keepalive=True,
+                decode_responses=False,
+            )
+            app.state.redis = Redis(connection_pool=app.state.redis_pool)
         except Exception:
             app.state.redis = InMemoryTrust()
     else:
         app.state.redis = InMemoryTrust()
+    try:
+        app.state.trust_sha = await load_trust_script(app.state.redis)
+    except Exception as e:
+        # Redis configured but unreachable: keep serving with the local store
+        app.state.logger.error(f"redis_unavailable error={e}")
+        app.state.redis = InMemoryTrust()
+        app.state.trust_sha = await load_trust_script(app.state.redis)
+    # Sibling workers cannot see this process's trust store or random audit key
+    if settings.WORKERS > 1 and (isinstance(app.state.redis, InMemoryTrust) or not settings.FERNET_KEY):
+        raise RuntimeError("WORKERS > 1 requires a reachable Redis and FERNET_KEY")
     # Initialize ML engine and load per-user profiles if available
     engine = BiometricEngine()
     async with AsyncSessionLocal() as session:
-        res = await session.execute(select(BiometricProfile))
-        profiles = res.scalars().all()
         # For simplicity, if any profile exists, load the most recent
-        if profiles:
-            engine.load_model_blob(profiles[-1].model_blob)
-        else:
-            engine.fit_baseline()
+        res = await session.execute(
+            select(BiometricProfile.model_blob).order_by(BiometricProfile.id.desc()).limit(1)
+        )
+        blob = res.scalar_one_or_none()
+    # Unpickling/fitting and compiling the forest are CPU-bound; keep them off the loop
+    if blob:
+        await asyncio.to_thread(engine.load_model_blob, blob)
+    else:
+        await asyncio.to_thread(engine.fit_baseline)
     app.state.engine = engine
-    # Ensure Fernet is initialized
-    get_fernet()
+    predict_workers = settings.PREDICT_WORKERS
+    if predict_workers < 0:
+        predict_workers = 0 if engine.scores_inline else min(4, os.cpu_count() or 1)
+    app.state.predict_executor = (
+        ThreadPoolExecutor(max_workers=predict_workers, thread_name_prefix="predict")
+        if predict_workers > 0
+        else None
+    )
+    # Build the audit cipher (and its key) once; handlers read it from app.state
+    app.state.audit_cipher = get_audit_cipher()
+    # Single background writer batches audit rows produced by the WebSocket
+    app.state.audit_queue = asyncio.Queue(maxsize=settings.AUDIT_QUEUE_MAXSIZE)
+    app.state.audit_task = asyncio.create_task(audit_writer(app.state.audit_queue))
 
 
-@app.on_event("shutdown")
 async def on_shutdown() -> None:
+    # Give the audit writer a chance to persist rows still in the queue
+    try:
+        await asyncio.wait_for(app.state.audit_queue.join(), timeout=5.0)
+    except asyncio.TimeoutError:
+        get_logger().error(f"audit_drain_timeout pending={app.state.audit_queue.qsize()}")
+    app.state.audit_task.cancel()
+    try:
+        await app.state.audit_task
+    except asyncio.CancelledError:
+        pass
+    if app.state.predict_executor is not None:
+        app.state.predict_executor.shutdown(wait=False, cancel_futures=True)
     redis = app.state.redis
     try:
         await redis.aclose()
+        # A client built on an explicit pool does not own it
+        if app.state.redis_pool is not None:
+            await app.state.redis_pool.disconnect()
     except Exception:
         pass
 
@@ -150,16 +293,18 @@ async def login(payload: dict, session: Annotated[AsyncSession, Depends(get_sess
     password = str(payload.get("password", ""))
     if not username or not password:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="missing credentials")
-    res = await session.execute(select(User).where(User.username == username))
+    res = await session.execute(_USER_BY_NAME, {"username": username})
     user = res.scalar_one_or_none()
+    # bcrypt is deliberately slow; hash/verify in a worker thread so
+    # concurrent logins do not stall the event loop
     if not user:
         # Optional: auto-provision for demo/dev
-        user = User(username=username, password_hash=get_password_hash(password))
+        password_hash = await asyncio.to_thread(get_password_hash, password)
+        user = User(username=username, password_hash=password_hash)
         session.add(user)
         await session.commit()
-        await session.refresh(user)
     else:
-        if not verify_password(password, user.password_hash):
+        if not await asyncio.to_thread(verify_password, password, user.password_hash):
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid credentials")
 
     token = create_access_token(subject=username)
@@ -167,20 +312,40 @@ async def login(payload: dict, session: Annotated[AsyncSession, Depends(get_sess
 
 
 # REST: History (encrypted logs; optionally decrypted)
+def _decrypt_all(cipher: AuditCipher, blobs: List[bytes]) -> List[Optional[str]]:
+    out: List[Optional[str]] = []
+    for blob in blobs:
+        try:
+            out.append(cipher.decrypt(blob).decode("utf-8"))
+        except Exception:
+            out.append(None)
+    return out
+
+
 @app.get("/stats/history")
 async def history(
     decrypt: bool = False,
     limit: int = 50,
+    format: Literal["b64", "hex"] = "b64",
+    include_blob: bool = True,
     user: Annotated[User, Depends(get_current_user)] = None,
     session: Annotated[AsyncSession, Depends(get_session)] = None,
 ):
-    res = await session.execute(
-        select(AuditLog).order_by(AuditLog.timestamp.desc()).limit(limit)
-    )
-    logs = res.scalars().all()
+    with_blob = decrypt or include_blob
+    stmt = select(AuditLog.id, AuditLog.timestamp, AuditLog.risk_score, AuditLog.client_id)
+    if with_blob:
+        stmt = stmt.add_columns(AuditLogBlob.encrypted_data).join(AuditLogBlob, AuditLogBlob.id == AuditLog.id)
+    # Metadata-only pages walk the timestamp index and never touch the blob table
+    res = await session.execute(stmt.order_by(AuditLog.timestamp.desc()).limit(limit))
+    logs = res.all()
     out = []
-    fernet = get_fernet()
-    for row in logs:
+    if decrypt:
+        # Decrypt the whole page in one worker-thread hop so large limits do
+        # not hold the event loop for the duration of the batch
+        cipher: AuditCipher = app.state.audit_cipher
+        blobs = [row.encrypted_data for row in logs]
+        plaintexts = await asyncio.get_running_loop().run_in_executor(None, _decrypt_all, cipher, blobs)
+    for i, row in enumerate(logs):
         item = {
             "id": row.id,
             "timestamp": str(row.timestamp),
@@ -188,18 +353,20 @@ async def history(
             "client_id": row.client_id,
         }
         if decrypt:
-            try:
-                plaintext = fernet.decrypt(row.encrypted_data)
-                item["raw"] = plaintext.decode("utf-8")
-            except Exception:
-                item["raw"] = None
-        else:
-            item["encrypted"] = row.encrypted_data.hex()
+            item["raw"] = plaintexts[i]
+        elif with_blob:
+            if format == "hex":
+                item["encrypted"] = row.encrypted_data.hex()
+            else:
+                item["encrypted"] = base64.b64encode(row.encrypted_data).decode("ascii")
         out.append(item)
     return {"items": out}
 
 
 # REST: Reset trust score
+RESET_BATCH_SIZE = 500
+
+
 @app.post("/system/reset")
 async def reset(
     client_id: Optional[str] = None,
@@ -207,60 +374,123 @@ async def reset(
 ):
     redis = app.state.redis
     if client_id:
-        await redis.delete(f"trust:{client_id}")
+        await redis.unlink(f"trust:{client_id}")
     else:
         # Non-destructive partial flush of trust keys only
-        # Scan keys to avoid flushing all Redis contents
-        async for key in redis.scan_iter(match="trust:*"):
-            await redis.delete(key)
+        # Scan keys to avoid flushing all Redis contents; keys are UNLINKed
+        # (reclaimed off the main thread) in batches sent as one pipeline
+        pipe = redis.pipeline(transaction=False)
+        batch: List[str] = []
+        async for key in redis.scan_iter(match="trust:*", count=RESET_BATCH_SIZE):
+            batch.append(key)
+            if len(batch) >= RESET_BATCH_SIZE:
+                pipe.unlink(*batch)
+                batch = []
+        if batch:
+            pipe.unlink(*batch)
+        await pipe.execute()
     return {"ok": True}
 
 
+_DATA_URL_RE = re.compile(r"^data:image/(png|jpeg|jpg);base64,")
+_UPLOAD_CHUNK_SIZE = 1 << 20
+# Same png/jpg restriction as the JSON endpoint's data-URL prefix
+_UPLOAD_EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/jpg": ".jpg"}
+
+
+def _write_new_file(path: Path, data: bytes) -> None:
+    with open(path, "xb") as f:
+        f.write(data)
+
+
+def _copy_new_file(path: Path, src: BinaryIO) -> None:
+    with open(path, "xb") as f:
+        shutil.copyfileobj(src, f, _UPLOAD_CHUNK_SIZE)
+
+
+async def _store_screenshot(ext: str, write: Callable[[Path, Any], None], src: Any) -> dict:
+    t = time.localtime()
+    ts = f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}_{t.tm_hour:02d}-{t.tm_min:02d}-{t.tm_sec:02d}"
+    # A random suffix makes the first candidate unique in practice; exclusive
+    # create still guards against the rare collision without probing with stat()
+    for _ in range(3):
+        base = f"{ts}-{secrets.token_hex(4)}{ext}"
+        path = app.state.screenshots_dir / base
+        try:
+            await asyncio.to_thread(write, path, src)
+        except FileExistsError:
+            continue
+        except Exception as e:
+            get_logger().error(f"screenshot_error error={e}")
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="save failed")
+        get_logger().info(f"screenshot_saved filename={base}")
+        return {"ok": True, "filename": base}
+    get_logger().error("screenshot_error error=filename collision")
+    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="save failed")
+
+
 @app.post("/media/screenshot")
+@app.post("/media/upload")
 async def save_screenshot(
     payload: dict = Body(...),
 ):
-    import base64
-    import re
-    from datetime import datetime
     fmt = str(payload.get("format", "png")).lower()
     image: str = str(payload.get("image", ""))
     if not image:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="missing image")
-    m = re.match(r"^data:image/(png|jpeg|jpg);base64,(.*)$", image)
     data_b64 = image
-    if m:
-        fmt = "jpg" if m.group(1) in ("jpeg", "jpg") else "png"
-        data_b64 = m.group(2)
+    if image.startswith("data:image/"):
+        # Match only the prefix so the payload is sliced once instead of
+        # being captured into a regex group
+        m = _DATA_URL_RE.match(image)
+        if m:
+            fmt = "jpg" if m.group(1) in ("jpeg", "jpg") else "png"
+            data_b64 = image[m.end():]
     try:
-        data = base64.b64decode(data_b64)
+        # a2b_base64 accepts an ASCII str directly and skips non-alphabet
+        # characters such as line breaks, so the payload is not re-encoded
+        data = binascii.a2b_base64(data_b64)
     except Exception:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="invalid base64")
-    ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     ext = ".jpg" if fmt == "jpg" else ".png"
-    base = ts + ext
-    path = app.state.screenshots_dir / base
-    idx = 1
-    while path.exists():
-        base = f"{ts}-{idx}{ext}"
-        path = app.state.screenshots_dir / base
-        idx += 1
+    return await _store_screenshot(ext, _write_new_file, data)
+
+
+# Binary variant of /media/screenshot: the image is sent as a multipart file
+# part, so it is neither base64-inflated nor held in memory as a whole; the
+# spooled upload is copied to disk in chunks off the event loop
+@app.post("/media/screenshot-bin")
+async def save_screenshot_bin(file: UploadFile = File(...)):
+    ext = _UPLOAD_EXTENSIONS.get(file.content_type or "")
+    if ext is None:
+        await file.close()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="unsupported image type")
     try:
-        with open(path, "wb") as f:
-            f.write(data)
-        get_logger().info(f"screenshot_saved filename={base}")
-        return {"ok": True, "filename": base}
-    except Exception as e:
-        get_logger().error(f"screenshot_error error={e}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="save failed")
-
-
-@app.post("/media/upload")
-async def upload_screenshot(payload: dict = Body(...)):
-    return await save_screenshot(payload)
+        return await _store_screenshot(ext, _copy_new_file, file.file)
+    finally:
+        await file.close()
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run("main:app", host="0.0.0.0", port=5051, reload=False)
\ No newline at end of file
+    workers = settings.WORKERS
+    if workers > 1:
+        reason = _multi_worker_blocker()
+        if reason:
+            setup_logging(Path("logs").resolve())
+            get_logger().warning(f"workers_reduced requested={workers} reason={reason}")
+            workers = 1
+    # Spawned workers re-read WORKERS from the environment
+    settings.WORKERS = workers
+    os.environ["WORKERS"] = str(workers)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=5051,
+        reload=False,
+        loop="auto",
+        http="auto",
+        workers=workers,
+        log_level="warning",
+    )